@@ -11,7 +11,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # =========== Copyright 2023 @ CAMEL-AI.org. All Rights Reserved. ===========
+import asyncio
+import atexit
+import functools
+import hashlib
 import json
+import logging
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, FrozenSet, Tuple
 
 import streamlit as st
 from camel.agents.deductive_reasoner_agent import DeductiveReasonerAgent
@@ -21,6 +32,33 @@ from camel.configs import ChatGPTConfig, FunctionCallingConfig
 from camel.functions import MATH_FUNCS, SEARCH_FUNCS
 from camel.societies import RolePlaying
 from camel.types import ModelType, TaskType
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Model config of the agents, the config is frozen and shared by them
+MODEL_CONFIG = ChatGPTConfig(max_tokens=2048, temperature=0)
+# Upper bound of the LLM calls waiting concurrently on the provider
+MAX_CONCURRENT_LLM_CALLS = 16
+# Number of chat turns whose dialogues are transformed into text together
+TRANSFORM_BATCH_SIZE = 8
+# Number of agents taking turns on the one-off MultiAgent calls, which are sent
+# concurrently
+MULTI_AGENT_POOL_SIZE = TRANSFORM_BATCH_SIZE
+# Number of InsightAgents and DeductiveReasonerAgents taking turns on the
+# subtasks of a pipeline, which run concurrently
+SUBTASK_AGENT_POOL_SIZE = 8
+# The agents end their reply with CAMEL_TASK_DONE when the task is completed,
+# so only the tail of the messages is searched for it
+TASK_DONE_TAIL_LENGTH = 64
+# The assistant ends its replies with this marker, it is removed from them
+NEXT_REQUEST_MARKER = "Next request."
+# Number of results kept by each of the memoized LLM calls
+CACHE_MAX_ENTRIES = 128
+# Buffer size of the output files, they are flushed whenever all the queued
+# outputs are written
+OUTPUT_FILE_BUFFER_SIZE = 1024 * 1024
+# Seconds between the checks that the background thread is still alive, while
+# waiting for the outputs to be written
+OUTPUT_WRITER_CHECK_INTERVAL = 1.0
 
 
 def main(
@@ -31,16 +69,7 @@ def main(
     search_enabled=False,
 ) -> None:
     # Model and agent initialization
-    model_config = ChatGPTConfig(max_tokens=2048, temperature=0)
-
-    multi_agent = MultiAgent(
-        model_type=model_type,
-        model_config=model_config,
-    )
-    insight_agent = InsightAgent(model_type=model_type, model_config=model_config)
-    deductive_reasoner_agent = DeductiveReasonerAgent(
-        model_type=model_type, model_config=model_config
-    )
+    multi_agent, insight_agent = get_session_agents(model_type)
 
     # Generate role with descriptions
     role_names = None
@@ -59,20 +88,31 @@ def main(
         context_text=context_text,
     )
 
-    # Draw the graph of the subtasks
+    # Collect the graph and the descriptions of the subtasks in one pass
     oriented_graph = {}
+    subtask_descriptions = {}
     for subtask_idx, details in subtasks_with_dependencies_dict.items():
-        deps = details["dependencies"]
-        oriented_graph[subtask_idx] = deps
-    multi_agent.draw_subtasks_graph(
-        oriented_graph=oriented_graph,
-        graph_file_path="apps/streamlit_ui/task_dependency_graph.png",
-    )
+        oriented_graph[subtask_idx] = details["dependencies"]
+        subtask_descriptions[subtask_idx] = details["description"]
+
+    # Draw the graph of the subtasks, only when it changed since the image
+    # was drawn. The hash of the drawn graph is kept next to the image.
+    graph_file_path = "apps/streamlit_ui/task_dependency_graph.png"
+    graph_hash = hashlib.blake2b(
+        json.dumps(oriented_graph, sort_keys=True).encode(), digest_size=8
+    ).hexdigest()
+    if read_drawn_graph_hash(graph_file_path) != graph_hash:
+        multi_agent.draw_subtasks_graph(
+            oriented_graph=oriented_graph,
+            graph_file_path=graph_file_path,
+        )
+        with open(f"{graph_file_path}.hash", "w") as file:
+            file.write(graph_hash)
 
-    # Get the list of subtasks
+    # Get the list of subtasks, sorted by the numbers in their ids
     subtasks = [
-        subtasks_with_dependencies_dict[key]["description"]
-        for key in sorted(subtasks_with_dependencies_dict.keys())
+        subtask_descriptions[subtask_idx]
+        for subtask_idx in sorted(subtask_descriptions, key=subtask_id_sort_key)
     ]
     send_subtasks_to_ui(subtasks=subtasks)
 
@@ -83,268 +123,608 @@ def main(
     )
 
     # Initialize the environment record
-    environment_record = {}  # the cache of the system
+    # the cache of the system
+    environment_record: Dict[FrozenSet[str], str] = {}
+    # the label sets of the record by label
+    environment_index: Dict[str, FrozenSet[FrozenSet[str]]] = {}
+    context_insights = run_insight_agent_on_context(
+        insight_agent, model_type.value, context_text
+    )
     if context_text is not None:
-        insights = insight_agent.run(context_text=context_text)
-        for insight in insights.values():
-            if insight["entity_recognition"] is None:
-                continue
-            tags = tuple(insight["entity_recognition"])
-            environment_record[tags] = insight
-
-    # Resolve the subtasks in sequence of the pipelines
-    for subtask_id in (
-        subtask for pipeline in parallel_subtask_pipelines for subtask in pipeline
-    ):
-        # Get the description of the subtask
-        subtask = subtasks_with_dependencies_dict[subtask_id]["description"]
-        subtask_labels = subtasks_with_dependencies_dict[subtask_id]["input_tags"]
-        # Get the insights from the environment for the subtask
-        insights_for_subtask = get_insights_from_environment(
-            subtask_id,
-            subtask,
-            subtask_labels,
-            environment_record,
-            deductive_reasoner_agent,
-            multi_agent,
-            insight_agent,
-            context_text,
+        update_environment(environment_record, environment_index, context_insights)
+    # The insights of the context are part of the insights of every subtask,
+    # serialize them once
+    context_insights_json = json.dumps(context_insights, indent=4)
+
+    # Resolve the subtasks pipeline by pipeline, the subtasks within one
+    # pipeline have no dependencies on each other and run concurrently
+    try:
+        asyncio.run(
+            resolve_subtask_pipelines(
+                parallel_subtask_pipelines,
+                subtasks_with_dependencies_dict,
+                role_descriptions_dict,
+                environment_record,
+                environment_index,
+                model_type,
+                context_insights_json,
+                search_enabled,
+            )
         )
+    finally:
+        # The outputs are exported right after main returns
+        flush_output_files()
+
+
+def read_drawn_graph_hash(graph_file_path):
+    if not os.path.exists(graph_file_path):
+        return None
+    try:
+        with open(f"{graph_file_path}.hash", "r") as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def subtask_id_sort_key(subtask_id):
+    # Compare the numbers in the ids as numbers, so that "10" comes after "2"
+    return [
+        int(part) if part.isdigit() else part
+        for part in re.split(r"(\d+)", str(subtask_id))
+    ]
 
-        # Get the role with the highest compatibility score
-        role_compatibility_scores_dict = multi_agent.evaluate_role_compatibility(
-            subtask, role_descriptions_dict
-        )
 
-        # Get the top two roles with the highest compatibility scores
-        ai_assistant_role = max(
-            role_compatibility_scores_dict,
-            key=lambda role: role_compatibility_scores_dict[role]["score_assistant"],
+async def resolve_subtask_pipelines(
+    parallel_subtask_pipelines,
+    subtasks_with_dependencies_dict,
+    role_descriptions_dict,
+    environment_record,
+    environment_index,
+    model_type,
+    context_insights_json,
+    search_enabled,
+):
+    # The worker threads get the script run context of the session, the
+    # memoized calls made from them look it up
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_LLM_CALLS,
+            initializer=add_script_run_ctx,
+            initargs=(None, get_script_run_ctx()),
         )
-        ai_user_role = max(
-            role_compatibility_scores_dict,
-            key=lambda role: role_compatibility_scores_dict[role]["score_user"],
+    )
+    # The agents keep the messages of their conversation, so the concurrent
+    # calls borrow them from pools, one call per agent at a time
+    multi_agent_pool = create_agent_pool(
+        get_session_agent_pool(MultiAgent, model_type, MULTI_AGENT_POOL_SIZE)
+    )
+    insight_agent_pool = create_agent_pool(
+        get_session_agent_pool(InsightAgent, model_type, SUBTASK_AGENT_POOL_SIZE)
+    )
+    deductive_reasoner_agent_pool = create_agent_pool(
+        get_session_agent_pool(
+            DeductiveReasonerAgent, model_type, SUBTASK_AGENT_POOL_SIZE
         )
+    )
 
-        ai_assistant_description = role_descriptions_dict[ai_assistant_role]
-        ai_user_description = role_descriptions_dict[ai_user_role]
+    # The agents of the role-playing sessions are configured the same way for
+    # every subtask, the frozen model config is shared by the assistant and
+    # the user
+    if search_enabled:
+        function_list = [*MATH_FUNCS, *SEARCH_FUNCS]
+    else:
+        function_list = [*MATH_FUNCS]
+
+    function_calling_config = FunctionCallingConfig.from_openai_function_list(
+        function_list=function_list,
+        kwargs=dict(temperature=0.7),
+    )
 
-        output_msg = ""
-        with st.expander(f"# {subtask_id}:\n\n{subtask}"):
-            send_two_role_descriptions_to_ui(
-                ai_assistant_role=ai_assistant_role,
-                ai_user_role=ai_user_role,
-                ai_assistant_description=ai_assistant_description,
-                ai_user_description=ai_user_description,
-            )
+    assistant_agent_kwargs = dict(
+        model_type=model_type,
+        model_config=function_calling_config,
+        function_list=function_list,
+    )
 
-            subtask_content = (
-                "- Description of TASK:\n"
-                + subtasks_with_dependencies_dict[subtask_id]["description"]
-                + "\n- Input of TASK:\n"
-                + subtasks_with_dependencies_dict[subtask_id]["input_content"]
-                + "\n- Output Standard for the completion of TASK:\n"
-                + subtasks_with_dependencies_dict[subtask_id]["output_standard"]
+    user_agent_kwargs = dict(
+        model_type=model_type,
+        model_config=function_calling_config,
+        # function_list=function_list,
+    )
+
+    # Score the compatibility of the roles with all the subtasks at once,
+    # instead of one roundtrip at the start of every subtask
+    role_compatibility_scores = await evaluate_role_compatibility_batch(
+        multi_agent_pool, subtasks_with_dependencies_dict, role_descriptions_dict
+    )
+
+    for pipeline in parallel_subtask_pipelines:
+        # Create the containers up front so that the layout of the page
+        # follows the order of the pipeline, not the order of completion
+        containers = {}
+        for subtask_id in pipeline:
+            subtask = subtasks_with_dependencies_dict[subtask_id]["description"]
+            containers[subtask_id] = (
+                st.expander(f"# {subtask_id}:\n\n{subtask}"),
+                st.expander(f"# {subtask_id}:\n\nSummary"),
             )
 
-            # You can use the following code to play the role-playing game
-            sys_msg_meta_dicts = [
-                dict(
-                    assistant_role=ai_assistant_role,
-                    user_role=ai_user_role,
-                    assistant_description=ai_assistant_description
-                    + "\n"
-                    + insights_for_subtask,
-                    user_description=ai_user_description + "\n" + "",
+        output_msgs = await asyncio.gather(
+            *(
+                run_subtask(
+                    subtask_id,
+                    subtasks_with_dependencies_dict,
+                    role_descriptions_dict,
+                    role_compatibility_scores[subtask_id],
+                    environment_record,
+                    environment_index,
+                    containers[subtask_id],
+                    assistant_agent_kwargs,
+                    user_agent_kwargs,
+                    multi_agent_pool,
+                    insight_agent_pool,
+                    deductive_reasoner_agent_pool,
+                    model_type,
+                    context_insights_json,
                 )
-                for _ in range(2)
-            ]  # System message meta data dicts
-
-            if search_enabled:
-                function_list = [*MATH_FUNCS, *SEARCH_FUNCS]
-            else:
-                function_list = [*MATH_FUNCS]
-
-            # Assistant model config
-            assistant_config = FunctionCallingConfig.from_openai_function_list(
-                function_list=function_list,
-                kwargs=dict(temperature=0.7),
+                for subtask_id in pipeline
             )
+        )
 
-            # User model config
-            user_config = FunctionCallingConfig.from_openai_function_list(
-                function_list=function_list,
-                kwargs=dict(temperature=0.7),
-            )
+        # Save the summaries in the order of the pipeline, not in the order of
+        # completion
+        save_output(
+            "downloads/CAMEL_multi_agent_summary.md",
+            "".join(
+                f"# {subtask_id}\n\n{output_msg}\n\n"
+                for subtask_id, output_msg in zip(pipeline, output_msgs)
+            ),
+        )
 
-            assistant_agent_kwargs = dict(
-                model_type=model_type,
-                model_config=assistant_config,
-                function_list=function_list,
-            )
 
-            user_agent_kwargs = dict(
-                model_type=model_type,
-                model_config=user_config,
-                # function_list=function_list,
+async def run_subtask(
+    subtask_id,
+    subtasks_with_dependencies_dict,
+    role_descriptions_dict,
+    role_compatibility_scores_dict,
+    environment_record,
+    environment_index,
+    containers,
+    assistant_agent_kwargs,
+    user_agent_kwargs,
+    multi_agent_pool,
+    insight_agent_pool,
+    deductive_reasoner_agent_pool,
+    model_type,
+    context_insights_json,
+):
+    subtask_expander, summary_expander = containers
+
+    # Get the description of the subtask
+    subtask_details = subtasks_with_dependencies_dict[subtask_id]
+    subtask = subtask_details["description"]
+    subtask_labels = subtask_details["input_tags"]
+    # Get the insights from the environment for the subtask
+    insights_for_subtask = await run_on_agent_pool(
+        deductive_reasoner_agent_pool,
+        get_insights_from_environment,
+        subtask_id,
+        subtask,
+        subtask_labels,
+        environment_record,
+        environment_index,
+        model_type,
+        context_insights_json,
+    )
+
+    # Get the top two roles with the highest compatibility scores
+    ai_assistant_role, ai_user_role = get_most_compatible_roles(
+        role_compatibility_scores_dict
+    )
+
+    ai_assistant_description = role_descriptions_dict[ai_assistant_role]
+    ai_user_description = role_descriptions_dict[ai_user_role]
+
+    # The outputs of the subtask are collected and saved at once when it ends,
+    # so that they are not interleaved with the outputs of its siblings
+    output_texts = [f"# {subtask_id}\n\n"]
+    with subtask_expander:
+        output_text = send_two_role_descriptions_to_ui(
+            ai_assistant_role=ai_assistant_role,
+            ai_user_role=ai_user_role,
+            ai_assistant_description=ai_assistant_description,
+            ai_user_description=ai_user_description,
+        )
+    output_texts.append(output_text)
+
+    subtask_content = (
+        f"- Description of TASK:\n{subtask}"
+        f"\n- Input of TASK:\n{subtask_details['input_content']}"
+        "\n- Output Standard for the completion of TASK:\n"
+        f"{subtask_details['output_standard']}"
+    )
+
+    # You can use the following code to play the role-playing game
+    sys_msg_meta_dict = dict(
+        assistant_role=ai_assistant_role,
+        user_role=ai_user_role,
+        assistant_description=f"{ai_assistant_description}\n{insights_for_subtask}",
+        user_description=ai_user_description + "\n",
+    )
+    # System message meta data dicts, RolePlaying only reads them so the
+    # assistant and the user share the same dict
+    sys_msg_meta_dicts = [sys_msg_meta_dict, sys_msg_meta_dict]
+
+    # Initialize the role-playing session
+    role_play_session = RolePlaying(
+        assistant_role_name=ai_assistant_role,
+        assistant_agent_kwargs=assistant_agent_kwargs,
+        user_role_name=ai_user_role,
+        user_agent_kwargs=user_agent_kwargs,
+        task_type=TaskType.ROLE_DESCRIPTION,
+        task_prompt=subtask_content,
+        with_task_specify=False,
+        extend_sys_msg_meta_dicts=sys_msg_meta_dicts,
+    )
+
+    # Start the role-playing to complete the subtask, the dialogues are
+    # transformed into text in batches instead of once per turn. The texts
+    # and the assistant messages are collected in lists, and joined once the
+    # role-playing is over.
+    dialogue_pairs = []
+    reproduced_assistant_msgs = []
+    assistant_msgs = []
+    chat_turn_limit, n = 50, 0
+    input_msg = role_play_session.init_chat()
+    while n < chat_turn_limit:
+        n += 1
+        # Step the session agent by agent, so that the reply of the user is
+        # rendered while the assistant is still generating its answer
+        try:
+            user_response, user_msg = await run_blocking(
+                step_role_play_agent,
+                role_play_session,
+                role_play_session.user_agent,
+                input_msg,
             )
+        except Exception as e:
+            # output a warning message and continue
+            with subtask_expander:
+                st.warning(f"Warning: {e}")
+            continue
+
+        if user_msg is None:
+            with subtask_expander:
+                st.warning(
+                    f"{ai_user_role} terminated. Reason: "
+                    f"{user_response.info.get('termination_reasons')}."
+                )
+            break
 
-            # Initialize the role-playing session
-            role_play_session = RolePlaying(
-                assistant_role_name=ai_assistant_role,
-                assistant_agent_kwargs=assistant_agent_kwargs,
-                user_role_name=ai_user_role,
-                user_agent_kwargs=user_agent_kwargs,
-                task_type=TaskType.ROLE_DESCRIPTION,
-                task_prompt=subtask_content,
-                with_task_specify=False,
-                extend_sys_msg_meta_dicts=sys_msg_meta_dicts,
+        with subtask_expander:
+            output_text = send_message_to_ui(
+                role="user",
+                role_name=ai_user_role,
+                message=user_msg.content,
+            )
+        output_texts.append(output_text)
+
+        try:
+            assistant_response, assistant_msg = await run_blocking(
+                step_role_play_agent,
+                role_play_session,
+                role_play_session.assistant_agent,
+                user_msg,
             )
+        except Exception as e:
+            # output a warning message and continue
+            with subtask_expander:
+                st.warning(f"Warning: {e}")
+            continue
+
+        if assistant_msg is None:
+            with subtask_expander:
+                st.warning(
+                    f"{ai_assistant_role} terminated. Reason: "
+                    f"{assistant_response.info.get('termination_reasons')}."
+                )
+            break
 
-            assistant_msg_record = (
-                "The TASK of the context text is:\n"
-                f"{subtask}\n"
-                "The solutions and the actions to "
-                "the TASK:\n"
+        with subtask_expander:
+            output_text = send_message_to_ui(
+                role="assistant",
+                role_name=ai_assistant_role,
+                message=assistant_msg.content,
             )
+        output_texts.append(output_text)
 
-            # Start the role-playing to complete the subtask
-            chat_turn_limit, n = 50, 0
-            input_msg = role_play_session.init_chat()
-            while n < chat_turn_limit:
-                n += 1
-                try:
-                    assistant_response, user_response = role_play_session.step(
-                        input_msg
-                    )
-                except Exception as e:
-                    # output a warning message and continue
-                    st.warning(f"Warning: {e}")
-                    continue
-
-                if assistant_response.terminated:
-                    st.warning(
-                        f"{ai_assistant_role} terminated. Reason: "
-                        f"{assistant_response.info['termination_reasons']}."
-                    )
-                    break
-                if user_response.terminated:
-                    st.warning(
-                        f"{ai_user_role} terminated. Reason: "
-                        f"{user_response.info['termination_reasons']}."
-                    )
-                    break
-
-                input_msg = assistant_response.msg
-
-                assistant_msg_record += (
-                    f"--- [{n}] ---\n"
-                    + assistant_response.msg.content.replace("Next request.", "").strip(
-                        "\n"
-                    )
-                    + "\n"
-                )
+        input_msg = assistant_msg
 
-                send_message_to_ui(
-                    role="user",
-                    role_name=ai_user_role,
-                    message=user_response.msg.content,
-                )
-                send_message_to_ui(
-                    role="assistant",
-                    role_name=ai_assistant_role,
-                    message=assistant_response.msg.content,
-                )
+        assistant_msgs.append(
+            (n, remove_next_request_marker(assistant_msg.content).strip("\n"))
+        )
 
-                reproduced_assistant_msg_with_category = (
-                    multi_agent.transform_dialogue_into_text(
-                        user_name=ai_user_role,
-                        assistant_name=ai_assistant_role,
-                        task_prompt=subtask,
-                        user_conversation=user_response.msg.content,
-                        assistant_conversation=assistant_response.msg.content,
-                    )
+        dialogue_pairs.append((user_msg.content, assistant_msg.content))
+        if len(dialogue_pairs) == TRANSFORM_BATCH_SIZE:
+            reproduced_assistant_msgs.extend(
+                await transform_dialogue_into_text_batch(
+                    multi_agent_pool,
+                    ai_user_role,
+                    ai_assistant_role,
+                    subtask,
+                    dialogue_pairs,
                 )
-                reproduced_assistant_msg = reproduced_assistant_msg_with_category[
-                    "text"
-                ]
-                output_msg += reproduced_assistant_msg + "\n"
-
-                if (
-                    "CAMEL_TASK_DONE" in user_response.msg.content
-                    or "CAMEL_TASK_DONE" in assistant_response.msg.content
-                ):
-                    break
-
-            insights_instruction = (
-                "The CONTEXT TEXT is the steps to resolve "
-                + "the TASK. The INSIGHTs should come solely"
-                + "from the assistant's solutions and actions."
             )
-            insights = insight_agent.run(
-                context_text=assistant_msg_record,
-                insights_instruction=insights_instruction,
+            dialogue_pairs = []
+
+        if (
+            "CAMEL_TASK_DONE" in user_msg.content[-TASK_DONE_TAIL_LENGTH:]
+            or "CAMEL_TASK_DONE" in assistant_msg.content[-TASK_DONE_TAIL_LENGTH:]
+        ):
+            break
+
+    save_output("downloads/CAMEL_multi_agent_output.md", "".join(output_texts))
+
+    reproduced_assistant_msgs.extend(
+        await transform_dialogue_into_text_batch(
+            multi_agent_pool, ai_user_role, ai_assistant_role, subtask, dialogue_pairs
+        )
+    )
+    output_msg = "".join(f"{msg}\n" for msg in reproduced_assistant_msgs)
+
+    assistant_msg_record = (
+        "The TASK of the context text is:\n"
+        f"{subtask}\n"
+        "The solutions and the actions to "
+        "the TASK:\n"
+    ) + "".join(f"--- [{turn}] ---\n{msg}\n" for turn, msg in assistant_msgs)
+
+    insights_instruction = (
+        "The CONTEXT TEXT is the steps to resolve "
+        + "the TASK. The INSIGHTs should come solely"
+        + "from the assistant's solutions and actions."
+    )
+    insights = await run_on_agent_pool(
+        insight_agent_pool,
+        InsightAgent.run,
+        context_text=assistant_msg_record,
+        insights_instruction=insights_instruction,
+    )
+
+    # Update the environment record, no lock is needed: the worker threads of
+    # the siblings only look entries up, and update_environment replaces the
+    # entries instead of changing them in place
+    update_environment(environment_record, environment_index, insights)
+
+    with summary_expander:
+        send_summary_to_ui(output_msg=output_msg)
+
+    return output_msg
+
+
+def step_role_play_agent(role_play_session, agent, input_msg):
+    # One half of RolePlaying.step: let the agent reply to the message of the
+    # other agent and record the reply in its memory. The message is None
+    # when the agent terminated or replied nothing, the role-playing stops.
+    # NOTE: this relies on RolePlaying._reduce_message_options, a private
+    # method of camel, and has to follow RolePlaying.step when camel changes.
+    response = agent.step(input_msg)
+    if response.terminated or response.msgs is None:
+        return response, None
+    msg = role_play_session._reduce_message_options(response.msgs)
+    agent.record_message(msg)
+
+    return response, msg
+
+
+def get_most_compatible_roles(role_compatibility_scores_dict):
+    # Find the best assistant and the best user in a single pass, the first
+    # role with the highest score wins like with max()
+    ai_assistant_role = ai_user_role = None
+    best_assistant_score = best_user_score = float("-inf")
+    for role, scores in role_compatibility_scores_dict.items():
+        if scores["score_assistant"] > best_assistant_score:
+            best_assistant_score, ai_assistant_role = scores["score_assistant"], role
+        if scores["score_user"] > best_user_score:
+            best_user_score, ai_user_role = scores["score_user"], role
+
+    return ai_assistant_role, ai_user_role
+
+
+async def evaluate_role_compatibility_batch(
+    multi_agent_pool, subtasks_with_dependencies_dict, role_descriptions_dict
+):
+    # Send the evaluations of the subtasks concurrently, on the agents of the
+    # pool
+    subtask_ids = list(subtasks_with_dependencies_dict)
+    role_compatibility_scores = await asyncio.gather(
+        *(
+            run_on_agent_pool(
+                multi_agent_pool,
+                MultiAgent.evaluate_role_compatibility,
+                subtasks_with_dependencies_dict[subtask_id]["description"],
+                role_descriptions_dict,
+            )
+            for subtask_id in subtask_ids
+        )
+    )
+
+    return dict(zip(subtask_ids, role_compatibility_scores))
+
+
+async def transform_dialogue_into_text_batch(
+    multi_agent_pool, user_name, assistant_name, task_prompt, dialogue_pairs
+):
+    # Send the dialogues of the batch concurrently, on the agents of the pool
+    reproduced_msgs_with_category = await asyncio.gather(
+        *(
+            run_on_agent_pool(
+                multi_agent_pool,
+                MultiAgent.transform_dialogue_into_text,
+                user_name=user_name,
+                assistant_name=assistant_name,
+                task_prompt=task_prompt,
+                user_conversation=user_conversation,
+                assistant_conversation=assistant_conversation,
             )
+            for user_conversation, assistant_conversation in dialogue_pairs
+        )
+    )
+
+    return [
+        reproduced_msg_with_category["text"]
+        for reproduced_msg_with_category in reproduced_msgs_with_category
+    ]
 
-            # Update the environment record
-            for insight in insights.values():
-                if insight["entity_recognition"] is None:
-                    continue
-                labels_key = tuple(insight["entity_recognition"])
-                environment_record[labels_key] = insight
 
-        with st.expander(f"# {subtask_id}:\n\nSummary"):
-            send_summary_to_ui(output_msg=output_msg)
+async def run_on_agent_pool(agent_pool, method, *args, **kwargs):
+    # Borrow an agent from the pool for the call, starting from a clean
+    # conversation, and give it back once the call is done
+    agent = await agent_pool.get()
+    try:
+        agent.reset()
+        return await run_blocking(method, agent, *args, **kwargs)
+    finally:
+        agent_pool.put_nowait(agent)
+
+
+async def run_blocking(func, *args, **kwargs):
+    # Run the blocking LLM call in a worker thread, so that the other
+    # subtasks of the pipeline keep going while it waits for the response
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(func, *args, **kwargs)
+    )
+
+
+def create_agent_pool(agents):
+    agent_pool = asyncio.Queue()
+    for agent in agents:
+        agent_pool.put_nowait(agent)
+    return agent_pool
+
+
+def get_session_agent_pool(agent_class, model_type, pool_size):
+    # Like the agents of main, the agents of the pools are created once per
+    # session instead of once per call or per subtask
+    session_pools = st.session_state.setdefault("agent_pools", {})
+    pool_key = (agent_class.__name__, model_type)
+    if pool_key not in session_pools:
+        session_pools[pool_key] = [
+            agent_class(model_type=model_type, model_config=MODEL_CONFIG)
+            for _ in range(pool_size)
+        ]
+    return session_pools[pool_key]
+
+
+def get_session_agents(model_type):
+    # Create the agents once per session instead of on every rerun. They are
+    # not shared by the sessions with st.cache_resource, since they keep the
+    # messages of their conversation.
+    session_agents = st.session_state.setdefault("agents", {})
+    if model_type not in session_agents:
+        session_agents[model_type] = (
+            MultiAgent(model_type=model_type, model_config=MODEL_CONFIG),
+            InsightAgent(model_type=model_type, model_config=MODEL_CONFIG),
+        )
+
+    agents = session_agents[model_type]
+    # Start from a clean conversation, like newly created agents
+    for agent in agents:
+        agent.reset()
+    return agents
 
 
 def get_insights_from_environment(
+    deductive_reasoner_agent,
     subtask_id,
     subtask,
     subtask_labels,
     environment_record,
-    deductive_reasoner_agent,
-    multi_agent,
-    insight_agent,
-    context_text,
+    environment_index,
+    model_type,
+    context_insights_json,
 ):
     # React to the environment, and get the insights from it
-    conditions_and_quality_json = (
-        deductive_reasoner_agent.deduce_conditions_and_quality(
-            starting_state="None", target_state=subtask
-        )
+    conditions_and_quality_json = deduce_conditions_and_quality(
+        deductive_reasoner_agent, model_type.value, subtask
     )
 
     target_labels = list(
         set(conditions_and_quality_json["labels"]) | set(subtask_labels)
     )
 
-    labels_sets = [list(labels_set) for labels_set in environment_record.keys()]
-
-    _, _, _, labels_retrieved_sets = multi_agent.get_retrieval_index_from_environment(
-        labels_sets=labels_sets, target_labels=target_labels
+    labels_retrieved_sets = retrieve_labels_sets_from_environment(
+        environment_index, target_labels
     )
 
-    # Retrive the necessaray insights from the environment
+    # Retrive the necessaray insights from the environment, they are
+    # serialized already
     retrieved_insights = [
-        environment_record[tuple(label_set)] for label_set in labels_retrieved_sets
+        environment_record[labels_set] for labels_set in labels_retrieved_sets
     ]
 
-    insights_none_pre_subtask = insight_agent.run(context_text=context_text)
     insights_for_subtask = (
         "\n====== CURRENT STATE =====\n"
         "The snapshot and the context of the TASK is presentd in "
         "the following insights which is close related to The "
         '"Insctruction" and the "Input":\n'
-        + f"{json.dumps(insights_none_pre_subtask, indent=4)}\n"
+        f"{context_insights_json}\n"
     )
 
-    insights_for_subtask += "\n".join(
-        [json.dumps(insight, indent=4) for insight in retrieved_insights]
-    )
+    insights_for_subtask += "\n".join(retrieved_insights)
 
     return insights_for_subtask
 
 
+def update_environment(environment_record, environment_index, insights):
+    for insight in insights.values():
+        if insight["entity_recognition"] is None:
+            continue
+        # The order of the labels does not matter, insights with the same
+        # labels share one entry
+        labels_key = frozenset(insight["entity_recognition"])
+        # Insights are inserted once and retrieved by many subtasks, so they
+        # are stored serialized
+        environment_record[labels_key] = json.dumps(insight, indent=4)
+        for label in labels_key:
+            # Replace the set instead of adding to it in place, the subtasks
+            # running in the worker threads may be reading the current one
+            labels_sets = environment_index.get(label, frozenset())
+            environment_index[label] = labels_sets | {labels_key}
+
+
+def retrieve_labels_sets_from_environment(environment_index, target_labels):
+    # Only the label sets sharing a label with the target are visited, ranked
+    # by the number of labels they share with it, then by their sorted labels
+    target_labels = set(target_labels)
+    candidate_labels_sets = set().union(
+        *(environment_index.get(label, ()) for label in target_labels)
+    )
+
+    return sorted(
+        candidate_labels_sets,
+        key=lambda labels_set: (
+            -len(target_labels.intersection(labels_set)),
+            sorted(labels_set),
+        ),
+    )
+
+
+# The results of the LLM calls below only depend on the text arguments, so they
+# are memoized. The agents are excluded from the cache key by the leading
+# underscore of their parameter names, the model name is part of the key.
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def deduce_conditions_and_quality(_deductive_reasoner_agent, model_name, subtask):
+    return _deductive_reasoner_agent.deduce_conditions_and_quality(
+        starting_state="None", target_state=subtask
+    )
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def run_insight_agent_on_context(_insight_agent, model_name, context_text):
+    return _insight_agent.run(context_text=context_text)
+
+
 def send_role_descriptions_to_ui(role_descriptions_dict={}):
     num_roles = len(role_descriptions_dict)
     with st.expander(f"Build {num_roles} AI agents:"):
@@ -353,12 +733,14 @@ def send_role_descriptions_to_ui(role_descriptions_dict={}):
             st.text(role_description)
 
     # Save the role descriptions
-    with open("downloads/CAMEL_multi_agent_output.md", "a") as file:
-        # Continue to write
-        for role, role_description in role_descriptions_dict.items():
-            file.write(f"Buid {num_roles} AI agents:\n")
-            file.write(f"{role}:\n{role_description}\n")
-        file.text("\n")
+    save_output(
+        "downloads/CAMEL_multi_agent_output.md",
+        "".join(
+            f"Buid {num_roles} AI agents:\n{role}:\n{role_description}\n"
+            for role, role_description in role_descriptions_dict.items()
+        )
+        + "\n",
+    )
 
 
 def send_two_role_descriptions_to_ui(
@@ -372,11 +754,11 @@ def send_two_role_descriptions_to_ui(
     st.write(f"{ai_user_role}:")
     st.write(ai_user_description)
 
-    # Save the role descriptions
-    with open("downloads/CAMEL_multi_agent_output.md", "a") as file:
-        file.write(f"{ai_assistant_role}:\n{ai_assistant_description}\n")
-        file.write(f"{ai_user_role}:\n{ai_user_description}\n")
-        file.write("\n")
+    # Return the role descriptions to save, the subtask saves its outputs
+    return (
+        f"{ai_assistant_role}:\n{ai_assistant_description}\n"
+        f"{ai_user_role}:\n{ai_user_description}\n\n"
+    )
 
 
 def send_subtasks_to_ui(subtasks=[]):
@@ -386,32 +768,95 @@ def send_subtasks_to_ui(subtasks=[]):
             st.write(subtask)
 
     # Save the subtasks
-    with open("downloads/CAMEL_multi_agent_output.md", "a") as file:
-        for i, subtask in enumerate(subtasks):
-            file.write(f"Subtask {i + 1}:\n")
-            file.write(subtask + "\n")
-        file.write("\n")
+    save_output(
+        "downloads/CAMEL_multi_agent_output.md",
+        "".join(f"Subtask {i + 1}:\n{subtask}\n" for i, subtask in enumerate(subtasks))
+        + "\n",
+    )
 
 
 def send_summary_to_ui(output_msg=""):
     st.write(output_msg.replace("\n", "\n\n") + "\n\n")
 
-    # Save the output message
-    with open("downloads/CAMEL_multi_agent_summary.md", "a") as file:
-        file.write(output_msg + "\n\n")
-
 
 def send_message_to_ui(role="", role_name="", message=""):
     if role not in ["user", "assistant"]:
         raise ValueError("The role should be one of 'user' or 'assistant'.")
 
+    message = remove_next_request_marker(message)
     with st.chat_message(role):
-        st.write(
-            f"AI {role}: {role_name}\n\n" f"{message.replace('Next request.', '')}"
-        )
+        st.write(f"AI {role}: {role_name}\n\n" f"{message}")
+
+    # Return the message to save, the subtask saves its outputs
+    return f"AI {role}: {role_name}\n\n" + message + "\n\n"
+
+
+def remove_next_request_marker(message):
+    # The marker is at the end of the reply, so only the end is checked
+    # instead of searching the whole message
+    message = message.rstrip()
+    if message.endswith(NEXT_REQUEST_MARKER):
+        return message[: -len(NEXT_REQUEST_MARKER)]
+    return message
 
-    # Save the messages
-    with open("downloads/CAMEL_multi_agent_output.md", "a") as file:
-        file.write(f"AI {role}: {role_name}\n\n")
-        file.write(message.replace("Next request.", "") + "\n")
-        file.write("\n")
+
+def save_output(file_path, text):
+    output_queue, _ = get_output_writer()
+    output_queue.put_nowait((file_path, text))
+
+
+def flush_output_files():
+    wait_for_output_files(*get_output_writer())
+
+
+@st.cache_resource
+def get_output_writer():
+    # The outputs are saved by a background thread, so that the script does not
+    # wait on the disk. The queue and the thread are created on the first save,
+    # and shared by the sessions and the reruns of the process, also after the
+    # module is reloaded. The queue holds (file path, text) pairs.
+    output_queue: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+    output_thread = threading.Thread(
+        target=write_output_files, args=(output_queue,), daemon=True
+    )
+    output_thread.start()
+    atexit.register(wait_for_output_files, output_queue, output_thread)
+    return output_queue, output_thread
+
+
+def wait_for_output_files(output_queue, output_thread):
+    # Wait until the background thread has written and flushed all the
+    # queued outputs. Unlike output_queue.join(), stop waiting if the thread
+    # died, since the outputs left in the queue would never be written.
+    with output_queue.all_tasks_done:
+        while output_queue.unfinished_tasks:
+            if not output_thread.is_alive():
+                logging.error("The outputs were not saved, their writer stopped.")
+                return
+            output_queue.all_tasks_done.wait(OUTPUT_WRITER_CHECK_INTERVAL)
+
+
+def write_output_files(output_queue):
+    # Keep one buffered handle per output file, instead of opening the file
+    # again for every output. The files are opened in append mode, so that
+    # the handles keep writing at the end after the app truncates them.
+    output_files = {}
+    while True:
+        file_path, text = output_queue.get()
+        try:
+            if file_path not in output_files:
+                output_files[file_path] = open(
+                    file_path,
+                    "a",
+                    buffering=OUTPUT_FILE_BUFFER_SIZE,
+                    encoding="utf-8",
+                )
+            output_files[file_path].write(text)
+            if output_queue.empty():
+                for file in output_files.values():
+                    file.flush()
+        except Exception:
+            # Keep the thread alive, the outputs queued after it are saved
+            logging.exception(f"Failed to save the output to {file_path}.")
+        finally:
+            output_queue.task_done()
@@ -156,7 +156,7 @@ if openai_api_key and task_prompt and context_text and submit_button:
     )
 
     # Export the outputs of the form
-    with open("downloads/CAMEL_multi_agent_output.md", "r") as file:
+    with open("downloads/CAMEL_multi_agent_output.md", "r", encoding="utf-8") as file:
         st.download_button(
             "Export the output to markdown",
             file,